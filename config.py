@@ -21,9 +21,14 @@ encoder_n_layers = 2  # Encoder number of layers
 decoder_n_layers = 2  # Encoder number of layers
 dropout = 0.1  # Dropout value
 batch_size = 64  # Batch size
+num_workers = 2  # Processes building training batches
+bucket_width = 3  # Input and target lengths grouped into one bucket when sampling batches
+pad_multiple = 8  # Compiled training pads targets to a multiple of this length, decoding the padding too
+compile_train = False  # Compile the teacher forced pass with torch.compile on the GPU
 
 # Configure training/optimization
 clip = 50.0  # Gradient clipping value
+grad_accum_steps = 1  # Batches to accumulate gradients over per optimizer step
 teacher_forcing_ratio = 1.0  # Teacher forcing ratio
 learning_rate = 0.0001  # Learning ratio value
 decoder_learning_ratio = 5.0  # Decoder learning ratio
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 import random
 import os
 from train import indexesFromSentence
@@ -81,6 +82,8 @@ def beam_decode(decoder, decoder_hidden, encoder_outputs,
             decoder_output, decoder_hidden = decoder(
                 decoder_input, decoder_hidden, encoder_outputs
             )
+            # The decoder returns logits, beam scores use probabilities
+            decoder_output = F.softmax(decoder_output, dim=1)
             topv, topi = decoder_output.topk(beam_size)
             term, top = sentence.addTopk(
                 topi, topv, decoder_hidden, beam_size, voc)
@@ -57,12 +57,17 @@ def run(args):
     # Use appropriate device
     encoder = encoder.to(device)
     decoder = decoder.to(device)
-    # Initialize optimizers
-    encoder_optimizer = optim.Adam(encoder.parameters(), lr=learning_rate)
+    # Initialize optimizers, on the GPU every parameter is updated by one
+    # fused kernel
+    encoder_optimizer = optim.Adam(
+        encoder.parameters(),
+        lr=learning_rate,
+        fused=USE_CUDA)
     decoder_optimizer = optim.Adam(
         decoder.parameters(),
         lr=learning_rate *
-        decoder_learning_ratio)
+        decoder_learning_ratio,
+        fused=USE_CUDA)
 
     if(args.train):
         loadFilename = None
@@ -54,38 +54,41 @@ class Attn(torch.nn.Module):
             self.attn = torch.nn.Linear(self.hidden_size * 2, hidden_size)
             self.v = torch.nn.Parameter(torch.FloatTensor(hidden_size))
 
+    # Energies are returned as (batch, decoder steps, encoder steps)
+
     # Loung first energy function
     def dot_score(self, hidden, encoder_output):
-        return torch.sum(hidden * encoder_output, dim=2)
+        return torch.bmm(hidden.transpose(0, 1), encoder_output.permute(1, 2, 0))
 
     # Second energy function
     def general_score(self, hidden, encoder_output):
         energy = self.attn(encoder_output)
-        return torch.sum(hidden * energy, dim=2)
+        return torch.bmm(hidden.transpose(0, 1), energy.permute(1, 2, 0))
 
     # Third energy function
     def concat_score(self, hidden, encoder_output):
-        energy = self.attn(
-            torch.cat(
-                (hidden.expand(
-                    encoder_output.size(0), -1, -1), encoder_output), 2)).tanh()
-        return torch.sum(self.v * energy, dim=2)
+        # Apply the hidden and encoder halves of the layer separately and
+        # broadcast them, instead of concatenating every pair of steps
+        weight_hidden, weight_encoder = self.attn.weight.split(
+            self.hidden_size, dim=1)
+        energy = torch.tanh(
+            F.linear(hidden, weight_hidden, self.attn.bias).unsqueeze(1) +
+            F.linear(encoder_output, weight_encoder).unsqueeze(0))
+        return torch.sum(self.v * energy, dim=3).permute(2, 0, 1)
 
     def forward(self, hidden, encoder_outputs):
-        # Calculate the attention weights (energies) based on the given method
-        if self.method == 'general':
-            attn_energies = self.general_score(hidden, encoder_outputs)
-        elif self.method == 'concat':
+        # Calculate the attention weights (energies) based on the given method.
+        # The layers created for the method pick the branch, TorchScript
+        # resolves hasattr statically and only compiles the matching function
+        if hasattr(self, 'v'):  # concat
             attn_energies = self.concat_score(hidden, encoder_outputs)
-        elif self.method == 'dot':
+        elif hasattr(self, 'attn'):  # general
+            attn_energies = self.general_score(hidden, encoder_outputs)
+        else:  # dot
             attn_energies = self.dot_score(hidden, encoder_outputs)
 
-        # Transpose max_length and batch_size dimensions
-        attn_energies = attn_energies.t()
-
-        # Return the softmax normalized probability scores (with added
-        # dimension)
-        return F.softmax(attn_energies, dim=1).unsqueeze(1)
+        # Return the softmax normalized probability scores over encoder steps
+        return F.softmax(attn_energies, dim=2)
 
 
 # Luong Attention Decoder implementation
@@ -113,24 +116,25 @@ class LuongAttnDecoderRNN(nn.Module):
         self.attn = Attn(attn_model, hidden_size)
 
     def forward(self, input_step, last_hidden, encoder_outputs):
-        # Note: we run this one step (word) at a time
-        # Get embedding of current input word
+        # Note: input_step is either a single step (word) or, under teacher
+        # forcing, the whole target sequence of shape (steps, batch)
+        # Get embedding of the input words
         embedded = self.embedding(input_step)
         embedded = self.embedding_dropout(embedded)
         # Forward through unidirectional GRU
         rnn_output, hidden = self.gru(embedded, last_hidden)
-        # Calculate attention weights from the current GRU output
+        # Calculate attention weights from the GRU outputs
         attn_weights = self.attn(rnn_output, encoder_outputs)
         # Multiply attention weights to encoder outputs to get new "weighted
-        # sum" context vector
+        # sum" context vectors
         context = attn_weights.bmm(encoder_outputs.transpose(0, 1))
         # Concatenate weighted context vector and GRU output using Luong eq. 5
-        rnn_output = rnn_output.squeeze(0)
-        context = context.squeeze(1)
-        concat_input = torch.cat((rnn_output, context), 1)
+        context = context.transpose(0, 1)
+        concat_input = torch.cat((rnn_output, context), 2)
         concat_output = torch.tanh(self.concat(concat_input))
-        # Predict next word using Luong eq. 6
+        # Predict next word using Luong eq. 6, the logits are returned and
+        # the softmax is left to the loss or the search
         output = self.out(concat_output)
-        output = F.softmax(output, dim=1)
-        # Return output and final hidden state
-        return output, hidden
+        # Return output and final hidden state, a single step keeps the
+        # (batch, vocabulary) output shape
+        return output.squeeze(0), hidden
@@ -3,15 +3,19 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch import optim
 import torch.backends.cudnn as cudnn
-import itertools
+from torch.utils.data import DataLoader, Dataset, Sampler
 import random
 import math
 import os
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from load import SOS_token, EOS_token, PAD_token
 from model import LuongAttnDecoderRNN
 from config import MAX_LENGTH, teacher_forcing_ratio, hidden_size, attn_model
+from config import num_workers, grad_accum_steps, bucket_width, pad_multiple
+from config import compile_train
 
 # Set CUDA variables and device settings
 USE_CUDA = torch.cuda.is_available()
@@ -24,140 +28,319 @@ cudnn.benchmark = True
 def indexesFromSentence(voc, sentence):
     return [voc.word2index[word] for word in sentence.split(' ')] + [EOS_token]
 
-# Pad the date with zeros
-def zeroPadding(l, fillvalue=PAD_token):
-    return list(itertools.zip_longest(*l, fillvalue=fillvalue))
-
-# Binary Matrix for masking
-def binaryMatrix(l, value=PAD_token):
-    m = []
-    for i, seq in enumerate(l):
-        m.append([])
-        for token in seq:
-            if token == PAD_token:
-                m[i].append(0)
-            else:
-                m[i].append(1)
-    return m
+# Tokenize every pair once into tensors of word indexes
+def encodePairs(voc, pairs):
+    return [(torch.LongTensor(indexesFromSentence(voc, pair[0])),
+             torch.LongTensor(indexesFromSentence(voc, pair[1])))
+            for pair in pairs]
+
+# Pads index sequences with zeros into a (max length, batch) tensor
+def padIndexes(indexes_batch):
+    return torch.nn.utils.rnn.pad_sequence(indexes_batch,
+                                           padding_value=PAD_token)
 
 # Returns padded input sequence tensor and lengths
-def inputVar(l, voc):
-    indexes_batch = [indexesFromSentence(voc, sentence) for sentence in l]
-    lengths = torch.tensor([len(indexes) for indexes in indexes_batch])
-    padList = zeroPadding(indexes_batch)
-    padVar = torch.LongTensor(padList)
+def inputVar(indexes_batch):
+    lengths = torch.tensor([indexes.size(0) for indexes in indexes_batch])
+    padVar = padIndexes(indexes_batch)
     return padVar, lengths
 
+# Length a target batch is padded to. When the forward pass is compiled it is
+# rounded up to a multiple of pad_multiple so only a few distinct shapes are
+# compiled. The padded steps still pay for the output projection and the
+# loss, so eager training keeps the real length
+def paddedTargetLength(max_target_len):
+    if compile_train and USE_CUDA:
+        return -(-max_target_len // pad_multiple) * pad_multiple
+    return max_target_len
+
 # Returns padded target sequence tensor, padding mask, and max target length
-def outputVar(l, voc):
-    indexes_batch = [indexesFromSentence(voc, sentence) for sentence in l]
-    max_target_len = max([len(indexes) for indexes in indexes_batch])
-    padList = zeroPadding(indexes_batch)
-    mask = binaryMatrix(padList)
-    mask = torch.ByteTensor(mask)
-    padVar = torch.LongTensor(padList)
+def outputVar(indexes_batch):
+    padVar = padIndexes(indexes_batch)
+    max_target_len = padVar.size(0)
+    padded_len = paddedTargetLength(max_target_len)
+    if padded_len != max_target_len:
+        padVar = F.pad(padVar, (0, 0, 0, padded_len - max_target_len),
+                       value=PAD_token)
+    mask = padVar != PAD_token
     return padVar, mask, max_target_len
 
-# Returns all items for a given batch of pairs
-def batch2TrainData(voc, pair_batch):
-    pair_batch.sort(key=lambda x: len(x[0].split(" ")), reverse=True)
+# Returns all items for a given batch of encoded pairs
+def batch2TrainData(pair_batch):
+    pair_batch.sort(key=lambda x: x[0].size(0), reverse=True)
     input_batch, output_batch = [], []
     for pair in pair_batch:
         input_batch.append(pair[0])
         output_batch.append(pair[1])
-    inp, lengths = inputVar(input_batch, voc)
-    output, mask, max_target_len = outputVar(output_batch, voc)
+    inp, lengths = inputVar(input_batch)
+    output, mask, max_target_len = outputVar(output_batch)
     return inp, lengths, output, mask, max_target_len
 
-# Loss calculation function
-def maskNLLLoss(inp, target, mask):
-    nTotal = mask.sum()
-    crossEntropy = -torch.log(torch.gather(inp, 1,
-                                           target.view(-1, 1)).squeeze(1))
-    loss = crossEntropy.masked_select(mask).mean()
-    loss = loss.to(device)
-    return loss, nTotal.item()
+# Dataset of encoded pairs, batches are sampled from it at random
+class PairsDataset(Dataset):
+    def __init__(self, encoded_pairs):
+        self.encoded_pairs = encoded_pairs
+
+    def __len__(self):
+        return len(self.encoded_pairs)
+
+    def __getitem__(self, index):
+        return self.encoded_pairs[index]
 
 """
-Main training loop
-This is where all the values are initialised and fed into Encoder and Decoder
+Length bucketed batch sampler
+Pairs are grouped by their input and target lengths and every batch is drawn
+from a single bucket, so the decoder runs only as many steps as the batch's
+targets need. Buckets smaller than a batch are merged into their nearest
+neighbour, and each bucket is walked in a shuffled order so a batch never
+repeats a pair
 """
-def train(
-        input_variable, lengths, target_variable, mask, max_target_len,
-    encoder, decoder, embedding, encoder_optimizer, decoder_optimizer,
-        batch_size, clip, max_length=MAX_LENGTH):
+class BucketBatchSampler(Sampler):
+    def __init__(self, encoded_pairs, batch_size, num_batches, bucket_width):
+        if len(encoded_pairs) < batch_size:
+            raise ValueError(len(encoded_pairs),
+                             "pairs are not enough for one batch.")
+        buckets = defaultdict(list)
+        for index, pair in enumerate(encoded_pairs):
+            buckets[(pair[0].size(0) // bucket_width,
+                     pair[1].size(0) // bucket_width)].append(index)
+        # Merge the smallest bucket into the closest one by length until
+        # every bucket holds at least one batch
+        while True:
+            key = min(buckets, key=lambda k: len(buckets[k]))
+            if len(buckets[key]) >= batch_size:
+                break
+            nearest = min((k for k in buckets if k != key),
+                          key=lambda k: abs(k[0] - key[0]) + abs(k[1] - key[1]))
+            buckets[nearest].extend(buckets.pop(key))
+        self.buckets = [torch.LongTensor(bucket) for bucket in buckets.values()]
+        # Buckets are picked in proportion to their size, so every pair is
+        # still drawn as often as with uniform sampling
+        self.weights = torch.tensor([len(bucket) for bucket in self.buckets],
+                                    dtype=torch.float64)
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+
+    def __iter__(self):
+        # Draw the bucket of every batch up front, instead of calling the
+        # Python RNG for every batch
+        bucket_ids = torch.multinomial(self.weights, self.num_batches,
+                                       replacement=True)
+        # Batches take consecutive slices of a shuffled bucket, which is
+        # shuffled again once it runs out
+        orders = [torch.randperm(len(bucket)) for bucket in self.buckets]
+        offsets = [0] * len(self.buckets)
+        for bucket_id in bucket_ids.tolist():
+            start = offsets[bucket_id]
+            if start + self.batch_size > len(orders[bucket_id]):
+                orders[bucket_id] = torch.randperm(len(orders[bucket_id]))
+                start = 0
+            offsets[bucket_id] = start + self.batch_size
+            positions = orders[bucket_id][start:start + self.batch_size]
+            yield self.buckets[bucket_id][positions].tolist()
+
+    def __len__(self):
+        return self.num_batches
 
-    # Zero gradients
-    encoder_optimizer.zero_grad()
-    decoder_optimizer.zero_grad()
-
-    # Set device options
-    input_variable = input_variable.to(device)
-    lengths = lengths.to(device)
-    target_variable = target_variable.to(device)
-    mask = mask.to(device)
+"""
+Batch prefetcher
+Copies the next batch to the GPU on a side stream while the current one trains
+"""
+class BatchPrefetcher:
+    def __init__(self, batches):
+        self.batches = iter(batches)
+        self.stream = torch.cuda.Stream() if USE_CUDA else None
+        self.preload()
+
+    # Start copying the next batch to the device
+    def preload(self):
+        self.next_batch = next(self.batches, None)
+        if self.next_batch is None or self.stream is None:
+            return
+        inp, lengths, output, mask, max_target_len = self.next_batch
+        with torch.cuda.stream(self.stream):
+            # Lengths stay on the CPU, pack_padded_sequence reads them on the host
+            self.next_batch = (inp.to(device, non_blocking=True), lengths,
+                               output.to(device, non_blocking=True),
+                               mask.to(device, non_blocking=True),
+                               max_target_len)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.next_batch
+        if batch is None:
+            raise StopIteration
+        if self.stream is not None:
+            # Wait for the copy and keep the memory alive on the compute stream
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            for tensor in (batch[0], batch[2], batch[3]):
+                tensor.record_stream(current_stream)
+        self.preload()
+        return batch
+
+# Loss calculation function, averaged over the batch (last) dimension so it
+# works for a single time step as well as a whole sequence. inp holds logits,
+# cross_entropy applies the log-softmax and the NLL in one fused call. Steps
+# that are padding for the whole batch have a loss of zero
+@torch.jit.script
+def maskNLLLoss(inp, target, mask):
+    nTotal = mask.sum(-1)
+    crossEntropy = F.cross_entropy(
+        inp.float().reshape(-1, inp.size(-1)), target.reshape(-1),
+        reduction='none').view_as(target)
+    loss = (crossEntropy * mask.float()).sum(-1) / nTotal.clamp(min=1)
+    return loss, nTotal
+
+# Copy every tensor of a (nested) checkpoint to the CPU, so it can be written
+# in the background while training keeps updating the originals
+def cpuSnapshot(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: cpuSnapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpuSnapshot(value) for value in obj)
+    return obj
+
+# Returns the (input length, padded target length) shapes a training batch
+# of the encoded pairs can have
+def batchShapes(encoded_pairs):
+    input_lengths = {pair[0].size(0) for pair in encoded_pairs}
+    target_lengths = {paddedTargetLength(pair[1].size(0))
+                      for pair in encoded_pairs}
+    return sorted((input_len, target_len) for input_len in input_lengths
+                  for target_len in target_lengths)
+
+# Run the forward pass and its backward on a dummy batch of every shape
+# training can see, so TorchScript profiles and fuses the decoder, or
+# torch.compile builds and captures its graphs, before training starts
+def warmupForward(forward_fn, encoder, decoder, sos_row, shapes):
+    batch_size = sos_row.size(1)
+    with torch.autocast(device_type=device.type, enabled=USE_CUDA):
+        for input_len, target_len in shapes:
+            input_variable = torch.full((input_len, batch_size), EOS_token,
+                                        dtype=torch.long, device=device)
+            lengths = torch.full((batch_size,), input_len, dtype=torch.long)
+            target_variable = torch.full((target_len, batch_size), EOS_token,
+                                         dtype=torch.long, device=device)
+            mask = torch.ones_like(target_variable, dtype=torch.bool)
+            for _ in range(2):
+                loss, _, _ = forward_fn(
+                    input_variable, lengths, target_variable, mask,
+                    encoder, decoder, sos_row)
+                loss.backward()
+    # Drop the dummy gradients, they must not reach the first step
+    encoder.zero_grad(set_to_none=True)
+    decoder.zero_grad(set_to_none=True)
 
-    # Initialize variables
-    loss = 0
-    print_losses = []
-    n_totals = 0
+"""
+Teacher forced forward pass
+The targets shifted by the SOS row are the inputs, so the whole batch of
+sequences goes through the decoder at once. Returns the loss to backpropagate
+and the loss sum and token count for printing
+"""
+def forward_and_loss(input_variable, lengths, target_variable, mask,
+                     encoder, decoder, sos_row):
 
     # Forward pass through encoder
     encoder_outputs, encoder_hidden = encoder(input_variable, lengths)
 
-    # Create initial decoder input (start with SOS tokens for each sentence)
-    decoder_input = torch.LongTensor([[SOS_token for _ in range(batch_size)]])
-    decoder_input = decoder_input.to(device)
-
     # Set initial decoder hidden state to the encoder's final hidden state
     decoder_hidden = encoder_hidden[:decoder.n_layers]
 
+    decoder_input = torch.cat((sos_row, target_variable[:-1]), 0)
+    decoder_output, _ = decoder(decoder_input, decoder_hidden, encoder_outputs)
+
+    # Calculate the loss of every time step
+    mask_loss, nTotal = maskNLLLoss(decoder_output, target_variable, mask)
+    return (mask_loss.sum(), (mask_loss.detach() * nTotal).sum(),
+            nTotal.sum())
+
+"""
+Main training loop
+This is where all the values are initialised and fed into Encoder and Decoder
+Gradients are accumulated into .grad, optimizer_apply adjusts the weights
+"""
+def forward_backward(
+        input_variable, lengths, target_variable, mask, max_target_len,
+        encoder, decoder, sos_row, scaler, grad_accum_steps=1,
+        forward_fn=forward_and_loss):
+
     # Determine if we are using teacher forcing this iteration
     use_teacher_forcing = True if random.random() < teacher_forcing_ratio else False
 
-    # Forward batch of sequences through decoder one time step at a time
-    if use_teacher_forcing:
-        for t in range(max_target_len):
-            decoder_output, decoder_hidden = decoder(
-                decoder_input, decoder_hidden, encoder_outputs
-            )
-            # Teacher forcing: next input is current target
-            decoder_input = target_variable[t].view(1, -1)
-            # Calculate and accumulate loss
-            mask_loss, nTotal = maskNLLLoss(
-                decoder_output, target_variable[t], mask[t])
-            loss += mask_loss
-            print_losses.append(mask_loss.item() * nTotal)
-            n_totals += nTotal
-    else:
-        for t in range(max_target_len):
-            decoder_output, decoder_hidden = decoder(
-                decoder_input, decoder_hidden, encoder_outputs
-            )
-            # No teacher forcing: next input is decoder's own current output
-            _, topi = decoder_output.topk(1)
-            decoder_input = torch.LongTensor(
-                [[topi[i][0] for i in range(batch_size)]])
-            decoder_input = decoder_input.to(device)
-            # Calculate and accumulate loss
-            mask_loss, nTotal = maskNLLLoss(
-                decoder_output, target_variable[t], mask[t])
-            loss += mask_loss
-            print_losses.append(mask_loss.item() * nTotal)
-            n_totals += nTotal
-
-    # Perform backpropatation
-    loss.backward()
-
-    # Clip gradients: gradients are modified in place
-    _ = torch.nn.utils.clip_grad_norm_(encoder.parameters(), clip)
-    _ = torch.nn.utils.clip_grad_norm_(decoder.parameters(), clip)
-
-    # Adjust model weights
-    encoder_optimizer.step()
-    decoder_optimizer.step()
-
-    return sum(print_losses) / n_totals
+    # Run the forward pass and the loss in mixed precision on the GPU
+    with torch.autocast(device_type=device.type, enabled=USE_CUDA):
+        if use_teacher_forcing:
+            # Teacher forcing: one (possibly compiled) pass over the batch
+            loss, total_loss_sum, total_n = forward_fn(
+                input_variable, lengths, target_variable, mask,
+                encoder, decoder, sos_row)
+        else:
+            # Initialize variables, the printed loss is accumulated on the
+            # device so it only has to be synchronised once per batch
+            loss = 0
+            total_loss_sum = torch.zeros((), device=device)
+            total_n = torch.zeros((), device=device)
+
+            # Forward pass through encoder
+            encoder_outputs, encoder_hidden = encoder(input_variable, lengths)
+
+            # Initial decoder input is the preallocated row of SOS tokens
+            decoder_input = sos_row
+
+            # Set initial decoder hidden state to the encoder's final hidden state
+            decoder_hidden = encoder_hidden[:decoder.n_layers]
+
+            # Forward batch of sequences through decoder one time step at a time
+            for t in range(max_target_len):
+                decoder_output, decoder_hidden = decoder(
+                    decoder_input, decoder_hidden, encoder_outputs
+                )
+                # No teacher forcing: next input is decoder's own current
+                # output, reshaped on the device into a (1, batch) step
+                _, topi = decoder_output.topk(1)
+                decoder_input = topi.view(1, -1)
+                # Calculate and accumulate loss
+                mask_loss, nTotal = maskNLLLoss(
+                    decoder_output, target_variable[t], mask[t])
+                loss += mask_loss
+                total_loss_sum += mask_loss.detach() * nTotal
+                total_n += nTotal
+
+    # Perform backpropatation on the scaled loss, averaged over the
+    # accumulated batches
+    scaler.scale(loss / grad_accum_steps).backward()
+
+    return (total_loss_sum / total_n).item()
+
+
+"""
+Optimizer step
+Applies the gradients accumulated by forward_backward and resets them
+"""
+def optimizer_apply(encoder, decoder, encoder_optimizer, decoder_optimizer,
+                    clip, scaler):
+
+    # Clip gradients: gradients are unscaled and then modified in place
+    scaler.unscale_(encoder_optimizer)
+    scaler.unscale_(decoder_optimizer)
+    _ = torch.nn.utils.clip_grad_norm_(encoder.parameters(), clip,
+                                       foreach=USE_CUDA)
+    _ = torch.nn.utils.clip_grad_norm_(decoder.parameters(), clip,
+                                       foreach=USE_CUDA)
+
+    # Adjust model weights, steps with inf/NaN gradients are skipped
+    scaler.step(encoder_optimizer)
+    scaler.step(decoder_optimizer)
+    scaler.update()
+
+    # Free gradients for the next accumulation, backward allocates new ones
+    encoder_optimizer.zero_grad(set_to_none=True)
+    decoder_optimizer.zero_grad(set_to_none=True)
 
 
 """
@@ -171,12 +354,31 @@ def trainIters(
         save_dir, n_iteration, batch_size, print_every, save_every, clip,
         corpus_name, loadFilename, train_name):
 
-    # Load batches for each iteration
-    training_batches = [
-                        batch2TrainData(
-                            voc,
-                            [random.choice(pairs) for _ in range(batch_size)])
-                        for _ in range(n_iteration)]
+    # Tokenize the corpus once, batches are sampled from the encoded pairs
+    encoded_pairs = encodePairs(voc, pairs)
+
+    # Decoder input for the first step, one SOS token for each sentence
+    sos_row = torch.full((1, batch_size), SOS_token, dtype=torch.long,
+                         device=device)
+
+    # Shapes the warm-up runs through before the timer starts
+    shapes = batchShapes(encoded_pairs)
+
+    forward_fn = forward_and_loss
+    if compile_train and USE_CUDA:
+        # Compile the teacher forced pass. Dynamo splits it at the GRUs and
+        # at the packing in the encoder, the pieces in between are fused and
+        # replayed as CUDA graphs. Every input and padded target length gets
+        # its own graphs, so allow one recompile per shape
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, len(shapes))
+        forward_fn = torch.compile(forward_and_loss, mode='reduce-overhead',
+                                   dynamic=False)
+    else:
+        # Compile the decoder with TorchScript to fuse its small ops, the
+        # parameters are shared with the original module and its optimizer
+        decoder = torch.jit.script(decoder)
+    warmupForward(forward_fn, encoder, decoder, sos_row, shapes)
 
     # Initializations
     print('Initializing ...')
@@ -186,15 +388,41 @@ def trainIters(
     if loadFilename:
         start_iteration = checkpoint['iteration'] + 1
 
+    # Build batches in worker processes while the GPU trains, one batch per
+    # remaining iteration with pairs of similar length drawn at random
+    dataset = PairsDataset(encoded_pairs)
+    batch_sampler = BucketBatchSampler(
+        encoded_pairs, batch_size, n_iteration - start_iteration + 1,
+        bucket_width)
+    loader = DataLoader(
+        dataset, batch_sampler=batch_sampler,
+        num_workers=num_workers, collate_fn=batch2TrainData,
+        pin_memory=USE_CUDA, persistent_workers=num_workers > 0,
+        prefetch_factor=2 if num_workers > 0 else None)
+
+    # Copy batches to the device ahead of the iteration that uses them
+    prefetcher = BatchPrefetcher(loader)
+
+    # Loss scaling for mixed precision, a no-op without CUDA
+    scaler = torch.amp.GradScaler(device.type, enabled=USE_CUDA)
+
+    # Zero gradients
+    encoder_optimizer.zero_grad(set_to_none=True)
+    decoder_optimizer.zero_grad(set_to_none=True)
+
+    # Checkpoints are written by a single background thread
+    checkpoint_saver = ThreadPoolExecutor(max_workers=1)
+    pending_save = None
+
     # Training loop
     print("Training...")
     for iteration in range(start_iteration, n_iteration + 1):
-        training_batch = training_batches[iteration - 1]
+        training_batch = next(prefetcher)
         # Extract fields from batch
         input_variable, lengths, target_variable, mask, max_target_len = training_batch
 
         # Run a training iteration with batch
-        loss = train(
+        loss = forward_backward(
             input_variable,
             lengths,
             target_variable,
@@ -202,13 +430,22 @@ def trainIters(
             max_target_len,
             encoder,
             decoder,
-            embedding,
-            encoder_optimizer,
-            decoder_optimizer,
-            batch_size,
-            clip)
+            sos_row,
+            scaler,
+            grad_accum_steps,
+            forward_fn)
         print_loss += loss
 
+        # Adjust model weights once every grad_accum_steps batches
+        if iteration % grad_accum_steps == 0 or iteration == n_iteration:
+            optimizer_apply(
+                encoder,
+                decoder,
+                encoder_optimizer,
+                decoder_optimizer,
+                clip,
+                scaler)
+
         # Print progress
         if iteration % print_every == 0:
             print_loss_avg = print_loss / print_every
@@ -228,13 +465,23 @@ def trainIters(
                                                        hidden_size, train_name))
             if not os.path.exists(directory):
                 os.makedirs(directory)
-            torch.save(
+            checkpoint_state = cpuSnapshot(
                 {'iteration': iteration, 'en': encoder.state_dict(),
                  'de': decoder.state_dict(),
                  'en_opt': encoder_optimizer.state_dict(),
                  'de_opt': decoder_optimizer.state_dict(),
-                 'loss': loss,
+                 'loss': float(loss),
                  'voc_dict': voc.__dict__,
-                 'embedding': embedding.state_dict()},
+                 'embedding': embedding.state_dict()})
+            # Surface errors of the previous save before queueing the next
+            if pending_save is not None:
+                pending_save.result()
+            pending_save = checkpoint_saver.submit(
+                torch.save, checkpoint_state,
                 os.path.join(
                     directory, '{}_{}.tar'.format(iteration, 'checkpoint')))
+
+    # Wait for the last checkpoint to be written
+    if pending_save is not None:
+        pending_save.result()
+    checkpoint_saver.shutdown()